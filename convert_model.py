@@ -6,15 +6,17 @@ import torch.nn.functional as F
 class ImageClassifierModel(nn.Module):
     def __init__(self):
         super().__init__()
-        self.conv1 = nn.Conv2d(1, 6, 5)
-        self.conv2 = nn.Conv2d(6, 16, 5)
+        # Stride-2 convs downsample in place of separate max-pool kernels
+        self.conv1 = nn.Conv2d(1, 6, 5, stride=2)
+        self.conv2 = nn.Conv2d(6, 16, 5, stride=2)
+        # 32x32 -> 14x14 -> 5x5, so the flatten size is unchanged
         self.fc1 = nn.Linear(16 * 5 * 5, 120)
         self.fc2 = nn.Linear(120, 84)
         self.fc3 = nn.Linear(84, 10)
 
     def forward(self, x: torch.Tensor):
-        x = F.max_pool2d(F.relu(self.conv1(x)), (2, 2))
-        x = F.max_pool2d(F.relu(self.conv2(x)), 2)
+        x = F.relu(self.conv1(x))
+        x = F.relu(self.conv2(x))
         x = torch.flatten(x, 1)
         x = F.relu(self.fc1(x))
         x = F.relu(self.fc2(x))
@@ -1,9 +1,14 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import argparse
+import hashlib
 import sys
 import os
 
+# ONNX opset of the exported models; part of the export cache key
+OPSET_VERSION = 11
+
 # Define the architecture of RRDBNet used in ESRGAN
 class ResidualDenseBlock(nn.Module):
     def __init__(self, nf=64, gc=32, bias=True):
@@ -14,15 +19,15 @@ class ResidualDenseBlock(nn.Module):
         self.conv3 = nn.Conv2d(nf + 2 * gc, gc, 3, 1, 1, bias=bias)
         self.conv4 = nn.Conv2d(nf + 3 * gc, gc, 3, 1, 1, bias=bias)
         self.conv5 = nn.Conv2d(nf + 4 * gc, nf, 3, 1, 1, bias=bias)
-        self.lrelu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
 
     def forward(self, x):
-        x1 = self.lrelu(self.conv1(x))
-        x2 = self.lrelu(self.conv2(torch.cat((x, x1), 1)))
-        x3 = self.lrelu(self.conv3(torch.cat((x, x1, x2), 1)))
-        x4 = self.lrelu(self.conv4(torch.cat((x, x1, x2, x3), 1)))
+        x1 = F.leaky_relu_(self.conv1(x), 0.2)
+        x2 = F.leaky_relu_(self.conv2(torch.cat((x, x1), 1)), 0.2)
+        x3 = F.leaky_relu_(self.conv3(torch.cat((x, x1, x2), 1)), 0.2)
+        x4 = F.leaky_relu_(self.conv4(torch.cat((x, x1, x2, x3), 1)), 0.2)
         x5 = self.conv5(torch.cat((x, x1, x2, x3, x4), 1))
-        return x5 * 0.2 + x
+        # Scaled residual as a single add kernel instead of mul + add
+        return torch.add(x, x5, alpha=0.2)
 
 
 class RRDB(nn.Module):
@@ -37,7 +42,7 @@ class RRDB(nn.Module):
         out = self.RDB1(x)
         out = self.RDB2(out)
         out = self.RDB3(out)
-        return out * 0.2 + x
+        return torch.add(x, out, alpha=0.2)
 
 
 class RRDBNet(nn.Module):
@@ -58,18 +63,17 @@ class RRDBNet(nn.Module):
         # Trunk convolution
         self.trunk_conv = nn.Conv2d(nf, nf, 3, 1, 1, bias=True)
         
-        # Upsampling layers
-        self.upconv1 = nn.Conv2d(nf, nf, 3, 1, 1, bias=True)
-        self.upconv2 = nn.Conv2d(nf, nf, 3, 1, 1, bias=True)
+        # Upsampling layers (sub-pixel conv: conv on the low-res map, then PixelShuffle)
+        self.upconv1 = nn.Conv2d(nf, nf * 4, 3, 1, 1, bias=True)
+        self.ps1 = nn.PixelShuffle(2)
+        self.upconv2 = nn.Conv2d(nf, nf * 4, 3, 1, 1, bias=True)
+        self.ps2 = nn.PixelShuffle(2)
         
         # High resolution convolution
         self.HRconv = nn.Conv2d(nf, nf, 3, 1, 1, bias=True)
         
         # Output convolution
         self.conv_last = nn.Conv2d(nf, out_nc, 3, 1, 1, bias=True)
-        
-        # Activation
-        self.lrelu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
 
     def forward(self, x):
         # First convolution
@@ -83,56 +87,255 @@ class RRDBNet(nn.Module):
         fea = fea + trunk
         
         # Upsampling
-        fea = self.lrelu(self.upconv1(F.interpolate(fea, scale_factor=2, mode='nearest')))
-        fea = self.lrelu(self.upconv2(F.interpolate(fea, scale_factor=2, mode='nearest')))
+        fea = F.leaky_relu_(self.ps1(self.upconv1(fea)), 0.2)
+        fea = F.leaky_relu_(self.ps2(self.upconv2(fea)), 0.2)
         
         # Output
-        out = self.conv_last(self.lrelu(self.HRconv(fea)))
+        out = self.conv_last(F.leaky_relu_(self.HRconv(fea), 0.2))
         
         return out
 
 
-def convert_to_onnx(input_path, output_path):
-    print(f"Converting {input_path} to {output_path}...")
+# For each sub-pixel phase (even, odd), which taps of a 3x3 conv applied after
+# 2x nearest upsampling fall on low-res offsets -1, 0 and +1
+_SUBPIXEL_TAPS = [
+    [[1, 0, 0], [0, 1, 1], [0, 0, 0]],
+    [[0, 0, 0], [1, 1, 0], [0, 0, 1]],
+]
+
+
+def nearest_conv_to_subpixel(weight, bias):
+    '''Convert a 3x3 conv that follows 2x nearest upsampling into the exactly
+    equivalent conv + PixelShuffle(2) weights acting on the low-res map'''
+    taps = weight.new_tensor(_SUBPIXEL_TAPS)
+    out_c, in_c = weight.shape[:2]
+    # PixelShuffle reads channel o*4 + a*2 + b into output pixel (o, 2h+a, 2w+b)
+    sub = torch.einsum('aui,bvj,ocij->oabcuv', taps, taps, weight)
+    return sub.reshape(out_c * 4, in_c, 3, 3), bias.repeat_interleave(4)
+
+
+def convert_upconv_weights(state_dict):
+    '''Rewrite original ESRGAN nearest-upsample upconv weights in place'''
+    for name in ('upconv1', 'upconv2'):
+        weight = state_dict.get(f'{name}.weight')
+        if weight is not None and weight.shape[0] == weight.shape[1]:
+            state_dict[f'{name}.weight'], state_dict[f'{name}.bias'] = \
+                nearest_conv_to_subpixel(weight, state_dict[f'{name}.bias'])
+    return state_dict
+
+
+def optimize_onnx(model_path):
+    '''Fold and fuse the exported graph offline with ONNX Runtime, in place'''
+    try:
+        import onnx
+        from onnx.external_data_helper import uses_external_data
+        import onnxruntime as ort
+    except ImportError:
+        print("ONNX/ONNX Runtime not installed. Skipping graph optimization.")
+        return
+    
+    # ORT would embed rewritten initializers next to the stale .data file
+    graph = onnx.load(model_path, load_external_data=False).graph
+    if any(uses_external_data(t) for t in graph.initializer):
+        print("Model uses external data. Skipping graph optimization.")
+        return
+    
+    optimized_path = os.path.splitext(model_path)[0] + '.opt.onnx'
+    options = ort.SessionOptions()
+    # Basic level only rewrites into standard ONNX ops; the extended/all levels
+    # emit ORT-specific fused kernels that OpenCV DNN cannot load
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_BASIC
+    options.optimized_model_filepath = optimized_path
+    try:
+        ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        os.replace(optimized_path, model_path)
+        print(f"Applied ONNX Runtime graph optimizations to {model_path}")
+    except Exception as e:
+        print(f"ONNX Runtime optimization warning: {e}")
+        print("Keeping the unoptimized model.")
+
+
+def quantize_onnx(model_path, tile_size=64, num_samples=32):
+    '''Write an INT8 (QDQ, per-channel weights) copy of the model next to it'''
+    try:
+        import numpy as np
+        import onnx
+        from onnx import version_converter
+        from onnxruntime.quantization import (CalibrationDataReader, QuantFormat,
+                                              QuantType, quantize_static)
+    except ImportError as e:
+        raise RuntimeError(f"INT8 quantization requires onnx and onnxruntime: {e}")
+    
+    class RandomTileReader(CalibrationDataReader):
+        '''Calibration feed of random RGB tiles in [0, 1]'''
+        def __init__(self):
+            self.remaining = num_samples
+        
+        def get_next(self):
+            if self.remaining == 0:
+                return None
+            self.remaining -= 1
+            return {'input': np.random.rand(1, 3, tile_size, tile_size).astype(np.float32)}
+    
+    quantized_path = os.path.splitext(model_path)[0] + '.int8.onnx'
+    print(f"Quantizing to INT8: {quantized_path}...")
+    fp32_model = onnx.load(model_path)
+    # Per-channel DequantizeLinear needs the axis attribute from opset 13;
+    # only the quantized copy is upgraded, the FP32 export keeps its opset
+    opset = next(o.version for o in fp32_model.opset_import if o.domain in ('', 'ai.onnx'))
+    if opset < 13:
+        fp32_model = version_converter.convert_version(fp32_model, 13)
+    quantize_static(
+        fp32_model,
+        quantized_path,
+        calibration_data_reader=RandomTileReader(),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QInt8,
+        weight_type=QuantType.QInt8,
+    )
+    print(f"Successfully wrote INT8 model to {quantized_path}")
+
+
+def load_state_dict(input_path):
+    '''Memory-map the checkpoint so tensors are not copied into a second buffer'''
+    try:
+        return torch.load(input_path, map_location='cpu', mmap=True, weights_only=True)
+    except Exception as e:
+        # Legacy (non-zip) checkpoints cannot be mmapped, and pickles holding
+        # more than tensors are rejected by weights_only
+        print(f"Memory-mapped load failed ({e}), falling back to a full load...")
+        return torch.load(input_path, map_location=torch.device('cpu'))
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def export_cache_key(input_digest, **options):
+    '''Key an export by checkpoint hash, this converter's source, the torch
+    and opset versions, and the export options that shape the output'''
+    h = hashlib.sha256(input_digest.encode())
+    with open(os.path.abspath(__file__), 'rb') as f:
+        h.update(f.read())
+    h.update(f"{torch.__version__}|{OPSET_VERSION}|{sorted(options.items())}".encode())
+    return h.hexdigest()
+
+
+def export_artifacts(output_path, int8=False):
+    '''Every file an export produces: the model, its INT8 copy if requested,
+    and any external tensor data those models reference'''
+    models = [output_path]
+    if int8:
+        models.append(os.path.splitext(output_path)[0] + '.int8.onnx')
+    artifacts = list(models)
+    try:
+        import onnx
+        from onnx.external_data_helper import uses_external_data
+    except ImportError:
+        return artifacts
+    
+    for path in models:
+        if not os.path.exists(path):
+            continue
+        for tensor in onnx.load(path, load_external_data=False).graph.initializer:
+            if uses_external_data(tensor):
+                location = next(e.value for e in tensor.external_data if e.key == 'location')
+                artifacts.append(os.path.join(os.path.dirname(path), location))
+    return sorted(set(artifacts))
+
+
+def is_export_cached(output_path, key, int8=False):
+    try:
+        with open(output_path + '.sha256') as f:
+            if f.read().strip() != key:
+                return False
+    except OSError:
+        return False
+    try:
+        return all(os.path.exists(p) for p in export_artifacts(output_path, int8))
+    except Exception:
+        # An unreadable model is stale, not a reason to abort
+        return False
+
+
+def write_export_cache(output_path, key):
+    with open(output_path + '.sha256', 'w') as f:
+        f.write(key + '\n')
+
+
+def run_exports(input_path, exports, strict_check=False):
+    '''Export each (output_path, options) pair whose .sha256 sidecar is stale,
+    loading the checkpoint at most once'''
+    input_digest = hash_file(input_path)
+    model = None
+    for output_path, options in exports:
+        key = export_cache_key(input_digest, **options)
+        if is_export_cached(output_path, key, options['int8']):
+            print(f"{output_path} is up to date. Skipping export.")
+            continue
+        
+        if model is None:
+            model = load_model(input_path)
+        verified = export_onnx(model, output_path, strict_check=strict_check, **options)
+        # Only cache exports that verified and produced every artifact
+        if verified and all(os.path.exists(p) for p in export_artifacts(output_path, options['int8'])):
+            write_export_cache(output_path, key)
+        else:
+            print(f"Not caching {output_path}; it will be exported again next run.")
+
+
+def load_model(input_path):
+    print(f"Loading {input_path}...")
     
     # Load the state dict
-    state_dict = torch.load(input_path, map_location=torch.device('cpu'))
+    state_dict = load_state_dict(input_path)
+    convert_upconv_weights(state_dict)
     
     # Create the ESRGAN model
     model = RRDBNet(in_nc=3, out_nc=3, nf=64, nb=23, gc=32)
     
-    # Try to load the state dict
-    try:
-        model.load_state_dict(state_dict)
+    # Load what matches and report anything that does not
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    if missing or unexpected:
+        print(f"Loaded with missing={len(missing)} unexpected={len(unexpected)} keys")
+    else:
         print("Successfully loaded state dict!")
-    except Exception as e:
-        print(f"Error loading state dict: {e}")
-        print("Attempting to rename keys for compatibility...")
-        
-        # Create a new state dict with renamed keys
-        new_state_dict = {}
-        for k, v in state_dict.items():
-            if k.startswith('RRDB_trunk.'):
-                # Keep original keys - model structure should match
-                new_state_dict[k] = v
-            else:
-                # Keep as is
-                new_state_dict[k] = v
-        
-        # Try loading with new state dict
-        try:
-            model.load_state_dict(new_state_dict)
-            print("Successfully loaded state dict after renaming keys!")
-        except Exception as e:
-            print(f"Still having issues loading state dict: {e}")
-            print("Using strict=False to load what we can...")
-            model.load_state_dict(state_dict, strict=False)
     
     # Set to evaluation mode
     model.eval()
+    return model
+
+
+def export_onnx(model, output_path, half=False, dynamic=True, static_size=256, int8=False,
+                strict_check=False):
+    '''Export with dynamic batch/height/width, or with a fixed
+    1x3xSxS input so runtimes can pre-tune kernels and capture CUDA graphs'''
+    # Quantization calibrates an FP32 graph
+    if int8 and half:
+        raise ValueError("INT8 quantization requires an FP32 export; drop --fp16")
     
-    # Create a dummy input tensor of size 64x64
-    dummy_input = torch.randn(1, 3, 64, 64)
+    if dynamic:
+        # Tracing only needs shapes, so use small uninitialised input;
+        # height and width are dynamic in the exported graph anyway
+        dummy_input = torch.empty(1, 3, 32, 32)
+        dynamic_axes = {
+            'input': {0: 'batch_size', 2: 'height', 3: 'width'},
+            'output': {0: 'batch_size', 2: 'height', 3: 'width'},
+        }
+    else:
+        dummy_input = torch.empty(1, 3, static_size, static_size)
+        dynamic_axes = None
+
+    # FP16 halves the bytes moved per conv on the memory-bound trunk
+    if half:
+        print("Converting model to FP16...")
+        model = model.half()
+        dummy_input = dummy_input.half()
     
     # Export to ONNX format
     print("Exporting to ONNX...")
@@ -141,41 +344,71 @@ def convert_to_onnx(input_path, output_path):
         dummy_input,
         output_path,
         export_params=True,
-        opset_version=11,
+        opset_version=OPSET_VERSION,
         do_constant_folding=True,
         input_names=['input'],
         output_names=['output'],
-        dynamic_axes={
-            'input': {0: 'batch_size', 2: 'height', 3: 'width'},
-            'output': {0: 'batch_size', 2: 'height', 3: 'width'},
-        }
+        dynamic_axes=dynamic_axes
     )
     
     print(f"Successfully exported ONNX model to {output_path}")
     
+    # ORT saves the graph as set up for its CPU session, which wraps FP16
+    # ops lacking CPU kernels in Casts; keep half exports as traced
+    if half:
+        print("Skipping graph optimization for the FP16 export.")
+    else:
+        optimize_onnx(output_path)
+    
     # Verify the model
+    verified = False
     try:
         import onnx
-        onnx_model = onnx.load(output_path)
-        onnx.checker.check_model(onnx_model)
+        # Checking by path resolves external data without loading it into
+        # memory; strict_check adds shape inference
+        onnx.checker.check_model(output_path, full_check=strict_check)
         print("ONNX model is valid!")
+        verified = True
     except ImportError:
         print("ONNX package not installed. Skipping verification.")
     except Exception as e:
         print(f"ONNX verification warning: {e}")
         print("The model may still work with OpenCV.")
+    
+    if int8:
+        quantize_onnx(output_path, tile_size=64 if dynamic else static_size)
+    return verified
+
+
+def convert_to_onnx(input_path, output_path, half=False, dynamic=True, static_size=256, int8=False,
+                    strict_check=False):
+    print(f"Converting {input_path} to {output_path}...")
+    options = dict(half=half, dynamic=dynamic, static_size=static_size, int8=int8)
+    run_exports(input_path, [(output_path, options)], strict_check=strict_check)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python convert_esrgan.py input.pth output.onnx")
-        sys.exit(1)
-    
-    input_file = sys.argv[1]
-    output_file = sys.argv[2]
+    parser = argparse.ArgumentParser(description="Convert an ESRGAN RRDBNet .pth model to ONNX")
+    parser.add_argument("input", help="input .pth state dict")
+    parser.add_argument("output", help="output .onnx path")
+    parser.add_argument("--fp16", action="store_true",
+                        help="export FP16 weights and activations (input/output become float16)")
+    parser.add_argument("--static-size", type=int, metavar="N",
+                        help="also export a fixed 1x3xNxN model to <output>_N_static.onnx; "
+                             "load it in fixed-tile pipelines for pre-tuned kernels and CUDA graphs")
+    parser.add_argument("--int8", action="store_true",
+                        help="also write a statically quantized INT8 copy of each export to <output>.int8.onnx")
+    parser.add_argument("--strict-check", action="store_true",
+                        help="add shape inference to the post-export ONNX check")
+    args = parser.parse_args()
     
     try:
-        convert_to_onnx(input_file, output_file)
+        exports = [(args.output, dict(half=args.fp16, dynamic=True, static_size=256, int8=args.int8))]
+        if args.static_size:
+            static_output = f"{os.path.splitext(args.output)[0]}_{args.static_size}_static.onnx"
+            exports.append((static_output, dict(half=args.fp16, dynamic=False,
+                                                static_size=args.static_size, int8=args.int8)))
+        run_exports(args.input, exports, strict_check=args.strict_check)
     except Exception as e:
         print(f"Error during conversion: {e}")
         sys.exit(1)
\ No newline at end of file